@@ -1,24 +1,45 @@
 import os
 import sys
 import logging
+import logging.config
 import re
+import time
+import threading
+import queue
+import atexit
+import collections
+from operator import attrgetter
+import dataclasses
+import functools
+from types import MappingProxyType
+from typing import Mapping
+from logging.handlers import QueueHandler, QueueListener
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
 from dotenv import load_dotenv
 
 from FunPayAPI import Account
 from FunPayAPI.updater.runner import Runner
 from FunPayAPI.updater.events import NewOrderEvent, NewMessageEvent
+from FunPayAPI.common.exceptions import RefundError, UnauthorizedError
 
 load_dotenv()
 FUNPAY_AUTH_TOKEN = os.getenv("FUNPAY_AUTH_TOKEN")
 BSP_API_KEY = os.getenv("BSP_API_KEY")
 CATEGORY_ID = int(os.getenv("CATEGORY_ID", "714"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "300"))
+BSP_CONNECT_TIMEOUT = float(os.getenv("BSP_CONNECT_TIMEOUT", "5"))
+BSP_READ_TIMEOUT = float(os.getenv("BSP_READ_TIMEOUT", str(min(30, REQUEST_TIMEOUT))))
 MIN_POINTS = int(os.getenv("MIN_POINTS", "100"))
 DEACTIVATE_CATEGORY_ID = int(os.getenv("DEACTIVATE_CATEGORY_ID", str(CATEGORY_ID)))
 LOG_FILE = os.getenv("LOG_FILE", "log.txt")
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+EVENT_QUEUE_LIMIT = int(os.getenv("EVENT_QUEUE_LIMIT", str(EVENT_WORKERS * 4)))
+STATE_TTL = int(os.getenv("STATE_TTL", str(24 * 3600)))
+DEACTIVATE_WORKERS = int(os.getenv("DEACTIVATE_WORKERS", "6"))
 
 def _env_bool_raw(name: str):
     return os.getenv(name)
@@ -52,17 +73,31 @@ BANNER_NOTE = os.getenv(
     "любая платная продажа — инициатива третьих лиц."
 ).strip()
 
+class _Dummy: RESET_ALL = ""
+class _Fore(_Dummy):
+    RED = GREEN = YELLOW = CYAN = MAGENTA = BLUE = WHITE = ""
+class _Style(_Dummy):
+    BRIGHT = NORMAL = ""
+
 try:
     from colorama import init as colorama_init, Fore, Style
     colorama_init(autoreset=True)
 except Exception:
-    class _Dummy: RESET_ALL = ""
-    class _Fore(_Dummy):
-        RED = GREEN = YELLOW = CYAN = MAGENTA = BLUE = WHITE = ""
-    class _Style(_Dummy):
-        BRIGHT = NORMAL = ""
     Fore, Style = _Fore(), _Style()
 
+if not (sys.stdout and sys.stdout.isatty()):
+    Fore, Style = _Fore(), _Style()
+
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except Exception:
+    import json
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    _json_loads = json.loads
+
 class ColorFormatter(logging.Formatter):
     LEVEL_COLORS = {
         logging.DEBUG: Fore.BLUE,
@@ -76,193 +111,286 @@ class ColorFormatter(logging.Formatter):
         message = super().format(record)
         return f"{color}{message}{Style.RESET_ALL}"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s:%(lineno)d | %(message)s"
-)
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(name)s:%(lineno)d | %(message)s"
+
+log_queue = queue.SimpleQueue()
+
+logging.config.dictConfig({
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "color": {"()": ColorFormatter, "fmt": LOG_FORMAT},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "color", "stream": "ext://sys.stdout"},
+        "file_queue": {"()": QueueHandler, "queue": log_queue},
+    },
+    "root": {"level": "INFO", "handlers": ["console", "file_queue"]},
+})
 
 file_handler = logging.FileHandler(LOG_FILE, mode="a", encoding="utf-8", delay=False)
-file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s:%(lineno)d | %(message)s")
 file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(file_formatter)
-logging.getLogger().addHandler(file_handler)
-
-for h in logging.getLogger().handlers:
-    try:
-        if isinstance(h, logging.FileHandler):
-            continue
-        fmt = h.formatter._fmt if hasattr(h, "formatter") and h.formatter else "%(message)s"
-        if isinstance(h, logging.StreamHandler) and getattr(h, "stream", None) in (sys.stdout, sys.stderr):
-            h.setFormatter(ColorFormatter(fmt))
-    except Exception:
-        pass
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
 
 logger = logging.getLogger("SteamPointsBot")
 
-def _log_banner():
+def _build_banner_lines() -> tuple[str, ...]:
     border = "═" * 78
-    logger.info(Style.BRIGHT + Fore.WHITE + border)
-    logger.info(Style.BRIGHT + Fore.CYAN  + "SteamPointsBot — информация о проекте")
-    logger.info(Style.BRIGHT + Fore.WHITE + border)
+    lines = [
+        Style.BRIGHT + Fore.WHITE + border,
+        Style.BRIGHT + Fore.CYAN  + "SteamPointsBot — информация о проекте",
+        Style.BRIGHT + Fore.WHITE + border,
+    ]
 
     if CREATOR_NAME:
         line = f"Создатель: {CREATOR_NAME}"
         if CREATOR_URL:
             line += f"  |  Контакт: {CREATOR_URL}"
-        logger.info(Fore.MAGENTA + line)
+        lines.append(Fore.MAGENTA + line)
     elif CREATOR_URL:
-        logger.info(Fore.MAGENTA + f"Контакт автора: {CREATOR_URL}")
+        lines.append(Fore.MAGENTA + f"Контакт автора: {CREATOR_URL}")
 
     if CHANNEL_URL:
-        logger.info(Fore.YELLOW + f"Канал с ботами/плагинами: {CHANNEL_URL}")
+        lines.append(Fore.YELLOW + f"Канал с ботами/плагинами: {CHANNEL_URL}")
     if GITHUB_URL:
-        logger.info(Fore.GREEN +  f"GitHub проекта: {GITHUB_URL}")
+        lines.append(Fore.GREEN +  f"GitHub проекта: {GITHUB_URL}")
 
-    logger.info(Fore.RED + Style.BRIGHT + "Дисклеймер: " + Fore.RED + BANNER_NOTE)
-    logger.info(Style.BRIGHT + Fore.WHITE + border)
+    lines.append(Fore.RED + Style.BRIGHT + "Дисклеймер: " + Fore.RED + BANNER_NOTE)
+    lines.append(Style.BRIGHT + Fore.WHITE + border)
+    return tuple(lines)
 
-BSP_BASE = "https://api.buysteampoints.com"
+_BANNER = "\n".join(_build_banner_lines())
 
+def _log_banner():
+    logger.info(_BANNER)
 
-STATE_BY_CHAT: dict[int, dict] = {}
+BSP_BASE = "https://api.buysteampoints.com"
+
+_BSP = requests.Session()
+_BSP.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(8, MAX_WORKERS * 2),
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        raise_on_status=False,
+    ),
+))
+_BSP.mount(f"{BSP_BASE}/api/buy", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=max(4, MAX_WORKERS),
+    max_retries=Retry(
+        total=2,
+        connect=2,
+        read=0,
+        status=0,
+        other=0,
+        allowed_methods=None,
+        raise_on_status=False,
+    ),
+))
+_BSP.headers.update({"content-type": "application/json"})
+_BSP_TIMEOUT = (BSP_CONNECT_TIMEOUT, BSP_READ_TIMEOUT)
+_BSP_BUY_TIMEOUT = (BSP_CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+
+BSP_BALANCE_TTL = float(os.getenv("BSP_BALANCE_TTL", "30"))
+_BAL_CACHE = {"ts": 0.0, "val": None}
+_BSP_BALANCE_EP = None
+_BSP_BALANCE_LOCK = threading.Lock()
+
+
+@dataclasses.dataclass(slots=True)
+class ChatState:
+    chat_id: int
+    buyer_id: int
+    order_id: str | None
+    points: int
+    step: str = "waiting_link"
+    steam_link: str | None = None
+    created: float = dataclasses.field(default_factory=time.monotonic)
+
+
+STATE_BY_CHAT: dict[int, ChatState] = {}
 USER_TO_CHATS: dict[int, set] = {}
 
 RE_STEAM_LINK = re.compile(
-    r"^https?://(www\.)?steamcommunity\.com/(id|profiles)/[A-Za-z0-9_./-]+$",
-    flags=re.IGNORECASE
+    r"^https?://(?:www\.)?steamcommunity\.com/(?:id|profiles)/[A-Za-z0-9_./-]+$",
+    flags=re.IGNORECASE | re.ASCII
 )
 
 EXECUTOR = ThreadPoolExecutor(max_workers=max(1, MAX_WORKERS))
-
-def _bind_state(state: dict):
-    chat_id = state["chat_id"]
-    buyer_id = state["buyer_id"]
-    STATE_BY_CHAT[chat_id] = state
-    USER_TO_CHATS.setdefault(buyer_id, set()).add(chat_id)
-    logger.debug(Fore.BLUE + f"[STATE] bind chat_id={chat_id}, buyer_id={buyer_id}. total_chats_for_user={len(USER_TO_CHATS[buyer_id])}")
-
-def _get_state(chat_id: int | None, user_id: int | None) -> dict | None:
-    if chat_id and chat_id in STATE_BY_CHAT:
-        return STATE_BY_CHAT[chat_id]
-
-    if user_id and user_id in USER_TO_CHATS and len(USER_TO_CHATS[user_id]) == 1:
-        only_chat_id = next(iter(USER_TO_CHATS[user_id]))
-        return STATE_BY_CHAT.get(only_chat_id)
-    return None
+EVENT_POOL = ThreadPoolExecutor(max_workers=max(1, EVENT_WORKERS))
+_EVENT_SLOTS = threading.BoundedSemaphore(max(1, EVENT_QUEUE_LIMIT))
+_AUX_POOL = ThreadPoolExecutor(max_workers=4)
+_BALANCE_POOL = ThreadPoolExecutor(max_workers=4)
+_STATE_LOCK = threading.RLock()
+_CHAT_EVENTS: dict[int, collections.deque] = {}
+_CHAT_EVENTS_LOCK = threading.Lock()
+_BIND_FMT = Fore.BLUE + "[STATE] bind chat_id=%s, buyer_id=%s. total_chats_for_user=%d"
+_POP_FMT = Fore.BLUE + "[STATE] pop chat_id=%s, buyer_id=%s"
+
+def _bind_state(state: ChatState):
+    chat_id = state.chat_id
+    buyer_id = state.buyer_id
+    with _STATE_LOCK:
+        STATE_BY_CHAT[chat_id] = state
+        USER_TO_CHATS.setdefault(buyer_id, set()).add(chat_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(_BIND_FMT, chat_id, buyer_id, len(USER_TO_CHATS.get(buyer_id, ())))
+
+def _get_state(chat_id: int | None, user_id: int | None) -> ChatState | None:
+    with _STATE_LOCK:
+        if chat_id and chat_id in STATE_BY_CHAT:
+            return STATE_BY_CHAT[chat_id]
+
+        if user_id and user_id in USER_TO_CHATS and len(USER_TO_CHATS[user_id]) == 1:
+            only_chat_id = next(iter(USER_TO_CHATS[user_id]))
+            return STATE_BY_CHAT.get(only_chat_id)
+        return None
 
 def _pop_state_by_chat(chat_id: int):
-    st = STATE_BY_CHAT.pop(chat_id, None)
-    if st:
-        buyer_id = st.get("buyer_id")
+    with _STATE_LOCK:
+        st = STATE_BY_CHAT.pop(chat_id, None)
+        if not st:
+            return
+        buyer_id = st.buyer_id
         if buyer_id in USER_TO_CHATS:
             USER_TO_CHATS[buyer_id].discard(chat_id)
             if not USER_TO_CHATS[buyer_id]:
                 USER_TO_CHATS.pop(buyer_id, None)
-        logger.debug(Fore.BLUE + f"[STATE] pop chat_id={chat_id}, buyer_id={buyer_id}")
+    logger.debug(_POP_FMT, chat_id, buyer_id)
+
+def _expire_states() -> int:
+    deadline = time.monotonic() - STATE_TTL
+    with _STATE_LOCK:
+        stale = [cid for cid, st in STATE_BY_CHAT.items() if st.created < deadline]
+        for cid in stale:
+            _pop_state_by_chat(cid)
+    if stale:
+        logger.info(Fore.BLUE + f"[STATE] Удалено просроченных состояний: {len(stale)} (старше {STATE_TTL} с)")
+    return len(stale)
+
+def _state_janitor(interval: float = 60.0):
+    while True:
+        time.sleep(interval)
+        try:
+            _expire_states()
+        except Exception:
+            logger.exception(Fore.RED + "[STATE] Ошибка при очистке состояний")
 
-def _parse_fixed_lots_env(s: str) -> dict[str, int]:
+def _parse_fixed_lots_env(s: str) -> Mapping[str, int]:
     mp = {}
     if not s:
-        return mp
+        return MappingProxyType(mp)
     for chunk in s.split(","):
         chunk = chunk.strip()
         if not chunk or ":" not in chunk:
             continue
         k, v = chunk.split(":", 1)
         try:
-            mp[str(k).strip()] = int(str(v).strip())
+            mp[sys.intern(str(k).strip())] = int(str(v).strip())
         except Exception:
             continue
-    return mp
+    return MappingProxyType(mp)
 
 FIXED_LOT_BY_ID = _parse_fixed_lots_env(os.getenv("FIXED_LOT_BY_ID", ""))
 ALLOW_TITLE_DETECTION = _env_bool("ALLOW_TITLE_DETECTION", True)
 NON_MULTIPLE_POINTS_POLICY = os.getenv("NON_MULTIPLE_POINTS_POLICY", "refund").strip().lower()
 
-RE_PTS_IN_TITLE = re.compile(r"(?<!\d)(\d{3,7})\s*(?:очк|очков|points)\b", re.IGNORECASE)
-RE_FROM_IN_TITLE = re.compile(r"\bот\s*\d+", re.IGNORECASE)
-RE_ANY_NUMBER = re.compile(r"(?<!\d)(\d{3,7})(?!\d)")
+RE_TITLE = re.compile(
+    r"(?P<ot>\bот\s*\d+)"
+    r"|(?P<pts>(?<!\d)(?P<pts_n>\d{3,7})\s*(?:очк|очков|points)\b)"
+    r"|(?P<num>(?<!\d)\d{3,7}(?!\d))",
+    re.IGNORECASE
+)
+_DIGITS_TBL = str.maketrans("", "", " \u00a0\u202f\t\r\n")
+
+_LOT_ID_GETTERS = tuple(map(attrgetter, ("lot_id", "lotId", "lot.id", "good.id", "item.id")))
 
 def _get_lot_id(order) -> str | None:
-    candidates = [
-        getattr(order, "lot_id", None),
-        getattr(order, "lotId", None),
-        getattr(getattr(order, "lot", None), "id", None),
-        getattr(getattr(order, "good", None), "id", None),
-        getattr(getattr(order, "item", None), "id", None),
-    ]
-    for c in candidates:
-        if c is None:
-            continue
+    for getter in _LOT_ID_GETTERS:
         try:
-            return str(c)
-        except Exception:
-            return None
+            c = getter(order)
+        except AttributeError:
+            continue
+        if c is not None:
+            return sys.intern(str(c))
     return None
 
+@functools.lru_cache(maxsize=2048)
+def _scan_title(title: str) -> tuple[int | None, str, tuple[int, ...]]:
+    pts_hit = None
+    numbers = []
+    for m in RE_TITLE.finditer(title):
+        kind = m.lastgroup
+        if kind == "ot":
+            return None, "title_has_ot", ()
+        if kind == "pts":
+            n = int(m.group("pts_n"))
+            if pts_hit is None:
+                pts_hit = n
+            numbers.append(n)
+        else:
+            numbers.append(int(m.group("num")))
+
+    if pts_hit is not None and pts_hit >= MIN_POINTS and pts_hit % 100 == 0:
+        return pts_hit, "title_regex", tuple(numbers)
+
+    candidates = [n for n in numbers if n >= MIN_POINTS and n % 100 == 0]
+    if candidates:
+        return max(candidates), "title_digits", tuple(numbers)
+    return None, "not_fixed", tuple(numbers)
+
 def _detect_fixed_unit_points(order) -> tuple[int | None, str]:
     lot_id = _get_lot_id(order)
     title = (getattr(order, "title", "") or "").strip()
 
-    if lot_id and lot_id in FIXED_LOT_BY_ID:
-        try:
-            val = int(FIXED_LOT_BY_ID[lot_id])
-            logger.info(Fore.MAGENTA + f"✅ Фикс-лот определён по ID: 1 шт. = {val} очков (lot_id={lot_id}).")
-            return val, f"lot_id:{lot_id}"
-        except Exception:
-            pass
+    val = FIXED_LOT_BY_ID.get(lot_id) if lot_id else None
+    if val is not None:
+        logger.info("%s✅ Фикс-лот определён по ID: 1 шт. = %s очков (lot_id=%s).", Fore.MAGENTA, val, lot_id)
+        return val, f"lot_id:{lot_id}"
 
     if not ALLOW_TITLE_DETECTION:
         return None, "not_fixed"
 
-    if RE_FROM_IN_TITLE.search(title):
-        logger.info(Fore.BLUE + f"ℹ️ Режим «от N»: заголовок содержит 'от ...'. Покупатель сам задаёт количество. Заголовок: '{title}'")
-        return None, "title_has_ot"
-
-    m = RE_PTS_IN_TITLE.search(title)
-    if m:
-        try:
-            val = int(m.group(1))
-            if val >= MIN_POINTS and val % 100 == 0:
-                logger.info(Fore.MAGENTA + f"✅ Фикс-лот по заголовку: 1 шт. = {val} очков. Заголовок: '{title}'")
-                return val, "title_regex"
-        except Exception:
-            pass
-
-    numbers = []
-    try:
-        numbers = [int(x) for x in RE_ANY_NUMBER.findall(title)]
-    except Exception:
-        numbers = []
-
-    if numbers:
-        candidates = [n for n in numbers if n >= MIN_POINTS and n % 100 == 0]
-        if candidates:
-            val = max(candidates)
+    val, src, numbers = _scan_title(title)
+    if src == "title_has_ot":
+        logger.info("%sℹ️ Режим «от N»: заголовок содержит 'от ...'. Покупатель сам задаёт количество. Заголовок: '%s'", Fore.BLUE, title)
+    elif src == "title_regex":
+        logger.info("%s✅ Фикс-лот по заголовку: 1 шт. = %s очков. Заголовок: '%s'", Fore.MAGENTA, val, title)
+    elif src == "title_digits":
+        if logger.isEnabledFor(logging.INFO):
+            candidates = [n for n in numbers if n >= MIN_POINTS and n % 100 == 0]
             logger.info(
-                Fore.MAGENTA
-                + f"✅ Фикс-лот по числу в названии: 1 шт. = {val} очков | найденные: {numbers} | подходящие: {candidates} | заголовок: '{title}'"
-            )
-            return val, "title_digits"
-        else:
-            logger.info(
-                Fore.BLUE
-                + f"ℹ️ В заголовке найдены числа, но они не подходят (минимум {MIN_POINTS}, кратно 100). "
-                  f"Найденные: {numbers} | заголовок: '{title}'"
+                "%s✅ Фикс-лот по числу в названии: 1 шт. = %s очков | найденные: %s | подходящие: %s | заголовок: '%s'",
+                Fore.MAGENTA, val, list(numbers), candidates, title
             )
+    elif numbers:
+        logger.info(
+            "%sℹ️ В заголовке найдены числа, но они не подходят (минимум %s, кратно 100). "
+            "Найденные: %s | заголовок: '%s'",
+            Fore.BLUE, MIN_POINTS, list(numbers), title
+        )
+    return val, src
 
-    return None, "not_fixed"
+def _first_positive_int(params: dict) -> tuple[str | None, int | None]:
+    for k, v in params.items():
+        s = str(v).translate(_DIGITS_TBL)
+        if s.isdecimal():
+            n = int(s)
+            if n > 0:
+                return k, n
+    return None, None
 
 def get_points_strict(order) -> tuple[int | None, str]:
     buyer_params = getattr(order, "buyer_params", {}) or {}
-    for k, v in buyer_params.items():
-        try:
-            n = int(str(v).strip().replace(" ", ""))
-            if n > 0:
-                logger.info(Fore.CYAN + f"ℹ️ Количество взято из параметров покупателя: {n} (buyer_params:{k})")
-                return n, f"buyer_params:{k}"
-        except Exception:
-            continue
+    k, n = _first_positive_int(buyer_params)
+    if n is not None:
+        logger.info("%sℹ️ Количество взято из параметров покупателя: %s (buyer_params:%s)", Fore.CYAN, n, k)
+        return n, f"buyer_params:{k}"
 
     amt = getattr(order, "amount", None)
     try:
@@ -270,7 +398,7 @@ def get_points_strict(order) -> tuple[int | None, str]:
     except Exception:
         amt = None
     if amt and amt >= 1:
-        logger.info(Fore.CYAN + f"ℹ️ Количество определено по числу штук: {amt} (amount)")
+        logger.info("%sℹ️ Количество определено по числу штук: %s (amount)", Fore.CYAN, amt)
         return amt, "amount"
 
     return None, "not_found"
@@ -288,180 +416,271 @@ def get_points(order) -> tuple[int | None, str]:
             units = 1
         total = unit_points * units
         logger.info(
-            Fore.MAGENTA
-            + f"🧮 Расчёт фикс-лота: {unit_points} очков × {units} шт. = {total} очков (источник: {src})"
+            "%s🧮 Расчёт фикс-лота: %s очков × %s шт. = %s очков (источник: %s)",
+            Fore.MAGENTA, unit_points, units, total, src
         )
         return total, f"fixed:{src}:{unit_points}x{units}"
 
     return get_points_strict(order)
 
-def bsp_create_order(points: int, steam_link: str):
+def bsp_create_order(points: int, steam_link: str, order_id):
+    idempotency_key = f"fp-{order_id}"
     payload = {
         "api_key": BSP_API_KEY,
         "puan": int(points),
-        "steam_link": steam_link.strip()
+        "steam_link": steam_link.strip(),
+        "idempotency_key": idempotency_key
     }
     try:
-        r = requests.post(
+        r = _BSP.post(
             f"{BSP_BASE}/api/buy",
-            json=payload,
-            timeout=REQUEST_TIMEOUT,
-            headers={"content-type": "application/json"}
+            data=_json_dumps(payload),
+            timeout=_BSP_BUY_TIMEOUT,
+            headers={"Idempotency-Key": idempotency_key}
         )
         data = {}
-        try:
-            data = r.json()
-        except Exception:
-            pass
+        if r.content:
+            try:
+                parsed = _json_loads(r.content)
+                if isinstance(parsed, dict):
+                    data = parsed
+            except ValueError:
+                pass
         ok = (r.status_code == 200) and bool(data.get("success"))
-        logger.info(
-            (Fore.GREEN if ok else Fore.RED)
-            + f"[BSP] Создание заказа: HTTP {r.status_code} | {str(data)[:300]}"
-        )
+        if logger.isEnabledFor(logging.INFO):
+            snippet = repr(data)[:300] if data else r.content[:300].decode("utf-8", "replace")
+            logger.info("%s[BSP] Создание заказа: HTTP %s | %s", Fore.GREEN if ok else Fore.RED, r.status_code, snippet)
         return ok, data, r
     except Exception as e:
         logger.error(Fore.RED + f"[BSP] Ошибка HTTP при создании заказа: {e}")
         return False, {"error": "HTTP error"}, None
 
+_BAL_KEYS = ("balance", "wallet", "remaining_balance", "amount", "available", "available_balance")
+_BAL_SUBKEYS = ("amount", "value", "available", "balance")
+_BAL_PATHS = tuple(p for k in _BAL_KEYS for p in ((k,), *((k, kk) for kk in _BAL_SUBKEYS)))
+
+def _parse_balance(data) -> float | None:
+    if isinstance(data, dict):
+        for path in _BAL_PATHS:
+            cur = data
+            for k in path:
+                cur = cur.get(k) if isinstance(cur, dict) else None
+                if cur is None:
+                    break
+            else:
+                if isinstance(cur, dict):
+                    continue
+                try:
+                    return float(cur)
+                except (TypeError, ValueError):
+                    continue
+        return None
+    try:
+        return float(data)
+    except (TypeError, ValueError):
+        return None
+
+def _try_balance_endpoint(ep) -> float | None:
+    method, url, params, json_body = ep
+    try:
+        body = _json_dumps(json_body) if json_body is not None else None
+        r = _BSP.request(method, url, params=params, data=body, timeout=_BSP_TIMEOUT)
+        if r.status_code != 200 or not r.content:
+            return None
+        return _parse_balance(_json_loads(r.content))
+    except Exception as e:
+        logger.debug("%s[BSP] Баланс: %s %s исключение: %s", Fore.YELLOW, method, url, e)
+        return None
+
+def _store_balance(bal: float):
+    _BAL_CACHE["val"] = bal
+    _BAL_CACHE["ts"] = time.monotonic()
+
 def bsp_check_balance() -> float | None:
+    global _BSP_BALANCE_EP
+    if _BAL_CACHE["val"] is not None and time.monotonic() - _BAL_CACHE["ts"] < BSP_BALANCE_TTL:
+        return _BAL_CACHE["val"]
+
     endpoints = [
         ("GET", f"{BSP_BASE}/api/balance", {"api_key": BSP_API_KEY}, None),
         ("POST", f"{BSP_BASE}/api/balance", None, {"api_key": BSP_API_KEY}),
         ("POST", f"{BSP_BASE}/api/wallet", None, {"api_key": BSP_API_KEY}),
         ("GET", f"{BSP_BASE}/api/info", {"api_key": BSP_API_KEY}, None),
     ]
-    for method, url, params, json_body in endpoints:
-        try:
-            r = requests.request(method, url, params=params, json=json_body, timeout=REQUEST_TIMEOUT)
-            if r.status_code != 200:
-                continue
-            data = r.json()
-            if isinstance(data, dict):
-                for k in ("balance", "wallet", "remaining_balance", "amount", "available", "available_balance"):
-                    if k in data:
-                        try:
-                            if isinstance(data[k], dict):
-                                for kk in ("amount", "value", "available", "balance"):
-                                    if kk in data[k]:
-                                        return float(data[k][kk])
-                            return float(data[k])
-                        except Exception:
-                            pass
-            try:
-                return float(data)
-            except Exception:
-                pass
-        except Exception as e:
-            logger.debug(Fore.YELLOW + f"[BSP] Баланс: {method} {url} исключение: {e}")
+    ep = _BSP_BALANCE_EP
+    if ep is not None:
+        bal = _try_balance_endpoint(ep)
+        if bal is not None:
+            _store_balance(bal)
+            return bal
+        logger.debug("%s[BSP] Баланс: запомненный эндпоинт %s %s перестал отвечать, повторный поиск.", Fore.YELLOW, ep[0], ep[1])
+        endpoints.remove(ep)
+        with _BSP_BALANCE_LOCK:
+            if _BSP_BALANCE_EP == ep:
+                _BSP_BALANCE_EP = None
+
+    futures = {_BALANCE_POOL.submit(_try_balance_endpoint, ep): ep for ep in endpoints}
+    try:
+        for fut in as_completed(futures, timeout=REQUEST_TIMEOUT):
+            bal = fut.result()
+            if bal is not None:
+                with _BSP_BALANCE_LOCK:
+                    _BSP_BALANCE_EP = futures[fut]
+                _store_balance(bal)
+                return bal
+    except FuturesTimeout:
+        logger.debug("%s[BSP] Баланс: эндпоинты не ответили за %s с", Fore.YELLOW, REQUEST_TIMEOUT)
+    finally:
+        for fut in futures:
+            fut.cancel()
     logger.warning(Fore.YELLOW + "[BSP] Не удалось получить баланс BSP (эндпоинт не распознан).")
     return None
 
+_SP_TBL = str.maketrans(",", " ")
+
 def _points_to_human(points: int) -> str:
-    return f"{points:,}".replace(",", " ")
+    return f"{points:,}".translate(_SP_TBL)
+
+_STEAM_PREFIXES = (
+    "https://steamcommunity.com/", "http://steamcommunity.com/",
+    "https://www.steamcommunity.com/", "http://www.steamcommunity.com/",
+)
+_STEAM_PREFIX_LEN = max(map(len, _STEAM_PREFIXES))
 
 def _steam_link_valid(link: str) -> bool:
-    return bool(RE_STEAM_LINK.match((link or "").strip()))
+    s = (link or "").strip()
+    return s[:_STEAM_PREFIX_LEN].lower().startswith(_STEAM_PREFIXES) and bool(RE_STEAM_LINK.match(s))
 
-def _nice_refund(account: Account, chat_id, order_id, user_text: str):
-    logger.info(Fore.YELLOW + f"↩️ Возврат по заказу {order_id}: {user_text}")
-    if chat_id:
-        account.send_message(chat_id, user_text + ("\n\nДеньги вернутся автоматически." if AUTO_REFUND else "\n\nСвяжитесь с админом для возврата."))
+def _refund_with_backoff(account: Account, order_id, tries: int = 4):
+    for i in range(tries):
+        try:
+            return account.refund(order_id)
+        except (RefundError, UnauthorizedError):
+            raise
+        except Exception as e:
+            if i == tries - 1:
+                raise
+            delay = 0.5 * 2 ** i
+            logger.warning(Fore.YELLOW + f"[FUNPAY] Возврат {order_id} не прошёл ({e}), повтор через {delay} с")
+            time.sleep(delay)
+
+def _send_and_refund(account: Account, chat_id, text: str, order_id) -> bool:
+    notice = _AUX_POOL.submit(account.send_message, chat_id, text) if chat_id else None
     try:
-        account.refund(order_id)
+        _refund_with_backoff(account, order_id)
+        refunded = True
         logger.warning(Fore.YELLOW + f"[FUNPAY] Возврат оформлен по заказу {order_id}.")
     except Exception as e:
+        refunded = False
         logger.error(Fore.RED + f"[FUNPAY] Не удалось оформить возврат {order_id}: {e}")
-
-def deactivate_category(account: Account, category_id: int) -> int:
-    deactivated = 0
-    my_lots = None
-
-    candidates = [
-        ("get_my_subcategory_lots", lambda cid: account.get_my_subcategory_lots(cid)),
-        ("get_my_lots", lambda cid: account.get_my_lots(cid) if hasattr(account, "get_my_lots") else None),
-        ("get_my_lots_all", lambda cid: account.get_my_lots() if hasattr(account, "get_my_lots") else None),
-    ]
-    for name, fn in candidates:
+    if notice is not None:
         try:
-            res = fn(category_id)
-            if res:
-                my_lots = res
-                logger.debug(Fore.CYAN + f"[LOTS] Получили лоты через {name}, count={len(res) if hasattr(res,'__len__') else 'unknown'}")
-                break
+            notice.result()
         except Exception as e:
-            logger.debug(Fore.YELLOW + f"[LOTS] Метод {name} выбросил исключение: {e}")
+            logger.error(Fore.RED + f"[FUNPAY] Не удалось отправить сообщение в чат {chat_id}: {e}")
+    return refunded
 
-    if my_lots is None:
-        logger.error(Fore.RED + f"[LOTS] Не удалось получить список лотов для категории {category_id}.")
-        return 0
+def _nice_refund(account: Account, chat_id, order_id, user_text: str):
+    logger.info(Fore.YELLOW + f"↩️ Возврат по заказу {order_id}: {user_text}")
+    _send_and_refund(
+        account, chat_id,
+        user_text + ("\n\nДеньги вернутся автоматически." if AUTO_REFUND else "\n\nСвяжитесь с админом для возврата."),
+        order_id
+    )
 
-    for lot in my_lots:
-        lot_id = getattr(lot, "id", None) if not isinstance(lot, dict) else lot.get("id") or lot.get("lot_id")
-        if not lot_id:
-            continue
+_LOTS_GETTER = None
+_LOT_FIELD_GETTER = None
+_LOT_SAVER = None
+_LOT_API_LOCK = threading.Lock()
+
+def _resolve_account_method(account: Account, names: tuple[str, ...]):
+    for name in names:
+        fn = getattr(type(account), name, None)
+        if callable(fn):
+            return name, fn
+    return None, None
+
+def _resolve_lot_api(account: Account) -> bool:
+    global _LOTS_GETTER, _LOT_FIELD_GETTER, _LOT_SAVER
+    with _LOT_API_LOCK:
+        if _LOT_SAVER is None:
+            lots = _resolve_account_method(account, ("get_my_subcategory_lots", "get_my_lots"))
+            field = _resolve_account_method(account, ("get_lot_fields", "get_lot_field", "get_lot", "get_lot_by_id"))
+            saver = _resolve_account_method(account, ("save_lot", "save_lot_field", "update_lot", "update_lot_field"))
+            _LOTS_GETTER, _LOT_FIELD_GETTER, _LOT_SAVER = lots, field, saver
+            logger.debug("%s[LOTS] API лотов: %s, %s, %s", Fore.CYAN, lots[0], field[0], saver[0])
+    return _LOTS_GETTER[1] is not None and _LOT_FIELD_GETTER[1] is not None and _LOT_SAVER[1] is not None
+
+def _deactivate_one(account: Account, lot) -> bool:
+    field_name, field_fn = _LOT_FIELD_GETTER
+    save_name, save_fn = _LOT_SAVER
+    lot_id = getattr(lot, "id", None) if not isinstance(lot, dict) else lot.get("id") or lot.get("lot_id")
+    if not lot_id:
+        return False
 
+    try:
+        field = field_fn(account, lot_id)
+    except Exception as e:
+        logger.debug("%s[LOTS] %s(%s) выбросил исключение: %s", Fore.YELLOW, field_name, lot_id, e)
         field = None
-        for fn_name in ("get_lot_fields", "get_lot_field", "get_lot", "get_lot_by_id"):
-            try:
-                fn = getattr(account, fn_name, None)
-                if callable(fn):
-                    field = fn(lot_id)
-                    if field:
-                        break
-            except Exception:
-                field = None
-
-        if not field:
-            logger.warning(Fore.YELLOW + f"[LOTS] Не удалось получить поля лота {lot_id}. Пропуск.")
-            continue
 
-        try:
-            if isinstance(field, dict):
-                field["active"] = False
-            else:
-                if hasattr(field, "active"):
-                    setattr(field, "active", False)
-                elif hasattr(field, "is_active"):
-                    setattr(field, "is_active", False)
-        except Exception as e:
-            logger.debug(Fore.YELLOW + f"[LOTS] Не удалось установить active=False для {lot_id}: {e}")
+    if not field:
+        logger.warning(Fore.YELLOW + f"[LOTS] Не удалось получить поля лота {lot_id}. Пропуск.")
+        return False
 
-        saved = False
-        for sm in ("save_lot", "save_lot_field", "update_lot", "update_lot_field"):
-            try:
-                fn = getattr(account, sm, None)
-                if callable(fn):
-                    fn(field)
-                    saved = True
-                    logger.info(Fore.YELLOW + f"[LOTS] Деактивирован лот {lot_id} через {sm}")
-                    deactivated += 1
-                    break
-            except Exception:
-                pass
+    try:
+        if isinstance(field, dict):
+            field["active"] = False
+        else:
+            if hasattr(field, "active"):
+                setattr(field, "active", False)
+            elif hasattr(field, "is_active"):
+                setattr(field, "is_active", False)
+    except Exception as e:
+        logger.debug("%s[LOTS] Не удалось установить active=False для %s: %s", Fore.YELLOW, lot_id, e)
 
-        if not saved:
-            try:
-                account.save_lot(field)
-                logger.info(Fore.YELLOW + f"[LOTS] Деактивирован лот {lot_id} через fallback save_lot")
-                deactivated += 1
-            except Exception as e:
-                logger.error(Fore.RED + f"[LOTS] Не удалось деактивировать лот {lot_id}: {e}")
+    try:
+        save_fn(account, field)
+        logger.info(Fore.YELLOW + f"[LOTS] Деактивирован лот {lot_id} через {save_name}")
+        return True
+    except Exception as e:
+        logger.error(Fore.RED + f"[LOTS] Не удалось деактивировать лот {lot_id}: {e}")
+        return False
+
+def deactivate_category(account: Account, category_id: int) -> int:
+    if not _resolve_lot_api(account):
+        logger.error(Fore.RED + "[LOTS] В FunPayAPI.Account нет методов для получения/сохранения лотов.")
+        return 0
+    lots_name, lots_fn = _LOTS_GETTER
+
+    try:
+        my_lots = lots_fn(account, category_id)
+    except Exception as e:
+        logger.debug("%s[LOTS] Метод %s выбросил исключение: %s", Fore.YELLOW, lots_name, e)
+        my_lots = None
+
+    if my_lots is None:
+        logger.error(Fore.RED + f"[LOTS] Не удалось получить список лотов для категории {category_id}.")
+        return 0
+    my_lots = list(my_lots)
+    logger.debug("%s[LOTS] Получили лоты через %s, count=%d", Fore.CYAN, lots_name, len(my_lots))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(DEACTIVATE_WORKERS, len(my_lots)))) as pool:
+        futures = [pool.submit(_deactivate_one, account, lot) for lot in my_lots]
+        deactivated = sum(1 for fut in as_completed(futures) if fut.result())
 
     logger.warning(Fore.YELLOW + f"[LOTS] Всего деактивировано: {deactivated}")
     return deactivated
 
-def _after_bsp_failure(account: Account, state: dict, err_text: str):
-    chat_id = state.get("chat_id")
-    order_id = state.get("order_id")
+def _after_bsp_failure(account: Account, state: ChatState, err_text: str):
+    chat_id = state.chat_id
+    order_id = state.order_id
 
     if AUTO_REFUND:
-        account.send_message(chat_id, "❌ Не удалось оформить пополнение очков.\n" + err_text + "\n\n🔁 Оформляю возврат средств…")
-        try:
-            account.refund(order_id)
+        text = "❌ Не удалось оформить пополнение очков.\n" + err_text + "\n\n🔁 Оформляю возврат средств…"
+        if _send_and_refund(account, chat_id, text, order_id):
             account.send_message(chat_id, "✅ Средства возвращены. Можно оформить заказ повторно позже.")
-            logger.warning(Fore.YELLOW + f"[FUNPAY] Возврат оформлен по заказу {order_id}")
-        except Exception as e:
-            logger.error(Fore.RED + f"[FUNPAY] Возврат не удался по заказу {order_id}: {e}")
+        else:
             account.send_message(chat_id, "❌ Не удалось выполнить автоматический возврат. Свяжитесь с админом.")
     else:
         account.send_message(chat_id, "❌ Не удалось оформить пополнение очков.\n" + err_text + "\n\n⚠️ Авто-возврат выключен. Напишите в чат для возврата.")
@@ -480,17 +699,17 @@ def _after_bsp_failure(account: Account, state: dict, err_text: str):
         else:
             logger.warning(Fore.MAGENTA + "[LOTS] AUTO_DEACTIVATE выключен — деактивацию лотов нужно сделать вручную.")
 
-def _process_bsp_order(account: Account, state: dict):
-    chat_id = state["chat_id"]
-    points = state["points"]
-    steam_link = state["steam_link"]
-    order_id = state["order_id"]
+def _process_bsp_order(account: Account, state: ChatState):
+    chat_id = state.chat_id
+    points = state.points
+    steam_link = state.steam_link
+    order_id = state.order_id
     try:
-        logger.info(Fore.BLUE + f"🧾 [WORKER] Создание BSP: {points} очков -> {steam_link} (order #{order_id})")
-        ok, data, r = bsp_create_order(points, steam_link)
+        logger.info("%s🧾 [WORKER] Создание BSP: %s очков -> %s (order #%s)", Fore.BLUE, points, steam_link, order_id)
+        ok, data, r = bsp_create_order(points, steam_link, order_id)
         if not ok:
-            err = (data.get("error") or (r.text[:200] if r is not None else "Unknown error"))
-            logger.error(Fore.RED + f"[BSP] Ошибка оформления: {err} (order #{order_id})")
+            err = (data.get("error") or (r.content[:200].decode("utf-8", "replace") if r is not None else "Unknown error"))
+            logger.error("%s[BSP] Ошибка оформления: %s (order #%s)", Fore.RED, err, order_id)
             _after_bsp_failure(account, state, f"Причина: {err}")
             return
 
@@ -503,9 +722,9 @@ def _process_bsp_order(account: Account, state: dict):
             "Чтобы завершить заказ — **подтвердите его у себя на FunPay** на странице заказа (кнопка «Подтвердить выполнение»).\n"
             "Если есть проблема — опишите ситуацию здесь в чате, администратор ответит как можно быстрее."
         )
-        logger.info(Fore.GREEN + f"✅ BSP заказ создан (order #{order_id}). Ждём подтверждение покупателя.")
+        logger.info("%s✅ BSP заказ создан (order #%s). Ждём подтверждение покупателя.", Fore.GREEN, order_id)
     except Exception as e:
-        logger.exception(Fore.RED + f"[WORKER] Исключение при оформлении BSP (order #{order_id}): {e}")
+        logger.exception("%s[WORKER] Исключение при оформлении BSP (order #%s): %s", Fore.RED, order_id, e)
         try:
             account.send_message(chat_id, "❌ Внутренняя ошибка при оформлении. Свяжитесь с админом.")
         except Exception:
@@ -513,22 +732,27 @@ def _process_bsp_order(account: Account, state: dict):
     finally:
         _pop_state_by_chat(chat_id)
 
-def handle_new_order(account: Account, order):
+def _order_subcategory_id(order) -> int | None:
     subcat = getattr(order, "subcategory", None) or getattr(order, "sub_category", None)
-    subcat_id = getattr(subcat, "id", None)
+    return getattr(subcat, "id", None)
+
+_ORDER_RULE = Style.BRIGHT + Fore.WHITE + "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
+
+def handle_new_order(account: Account, order):
+    subcat_id = _order_subcategory_id(order)
     if subcat_id != CATEGORY_ID:
-        logger.info(Fore.BLUE + f"[ORDER] Пропуск заказа {order.id} (subcategory {subcat_id} != {CATEGORY_ID})")
+        logger.info("%s[ORDER] Пропуск заказа %s (subcategory %s != %s)", Fore.BLUE, order.id, subcat_id, CATEGORY_ID)
         return
 
     chat_id = getattr(order, "chat_id", None)
     buyer_id = getattr(order, "buyer_id", None)
 
-    logger.info(Style.BRIGHT + Fore.WHITE + "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
-    logger.info(Style.BRIGHT + Fore.CYAN + f"🆕 Новый заказ #{getattr(order, 'id', 'unknown')} | Покупатель: {buyer_id}")
+    logger.info(_ORDER_RULE)
+    logger.info("%s🆕 Новый заказ #%s | Покупатель: %s", Style.BRIGHT + Fore.CYAN, getattr(order, "id", "unknown"), buyer_id)
     title = getattr(order, "title", None)
     if title:
-        logger.info(Fore.CYAN + f"📦 Товар: {title}")
-    logger.info(Style.BRIGHT + Fore.WHITE + "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
+        logger.info("%s📦 Товар: %s", Fore.CYAN, title)
+    logger.info(_ORDER_RULE)
 
     points_raw, src = get_points(order)
     if points_raw is None:
@@ -555,7 +779,7 @@ def handle_new_order(account: Account, order):
                 else:
                     account.send_message(chat_id, msg + "\n\nАвто-возврат отключён, напишите в чат для возврата.")
                 return
-            logger.info(Fore.CYAN + f"🔧 Количество скорректировано: {points} → {new_points} по политике 'floor'.")
+            logger.info("%s🔧 Количество скорректировано: %s → %s по политике 'floor'.", Fore.CYAN, points, new_points)
             points = new_points
             corrected_note = "\nℹ️ Некратное 100 значение было уменьшено до *" + _points_to_human(points) + "* согласно настройке продавца."
         else:
@@ -577,13 +801,12 @@ def handle_new_order(account: Account, order):
             account.send_message(chat_id, msg + "\n\nАвто-возврат отключён, напишите в чат для возврата.")
         return
 
-    state = {
-        "step": "waiting_link",
-        "order_id": getattr(order, "id", None),
-        "chat_id": chat_id,
-        "buyer_id": buyer_id,
-        "points": points
-    }
+    state = ChatState(
+        chat_id=chat_id,
+        buyer_id=buyer_id,
+        order_id=getattr(order, "id", None),
+        points=points
+    )
     _bind_state(state)
 
     msg = (
@@ -594,7 +817,18 @@ def handle_new_order(account: Account, order):
         "`https://steamcommunity.com/id/ваш_id` или `https://steamcommunity.com/profiles/7656119...`"
     )
     account.send_message(chat_id, msg)
-    logger.info(Fore.BLUE + f"⏳ Ожидаем ссылку Steam от покупателя {buyer_id}… Источник: {src}, очков к зачислению: {points}")
+    logger.info("%s⏳ Ожидаем ссылку Steam от покупателя %s… Источник: %s, очков к зачислению: %s", Fore.BLUE, buyer_id, src, points)
+
+_INVALID_LINK_MSG = (
+    "⚠️ Невалидная ссылка. Пример:\n"
+    "`https://steamcommunity.com/id/gabelogannewell`\n"
+    "или\n"
+    "`https://steamcommunity.com/profiles/7656119...`"
+)
+
+def _reply_invalid_link(account: Account, chat_id, link: str):
+    account.send_message(chat_id, _INVALID_LINK_MSG)
+    logger.info("%s🚫 Невалидная ссылка Steam: %s", Fore.YELLOW, link)
 
 def handle_new_message(account: Account, message):
     user_id = getattr(message, "author_id", None)
@@ -605,56 +839,55 @@ def handle_new_message(account: Account, message):
     if not state:
         return
 
-    if state["step"] == "waiting_link":
+    if state.step == "waiting_link":
         link = text
         if not _steam_link_valid(link):
-            account.send_message(
-                chat_id,
-                "⚠️ Невалидная ссылка. Пример:\n"
-                "`https://steamcommunity.com/id/gabelogannewell`\n"
-                "или\n"
-                "`https://steamcommunity.com/profiles/7656119...`"
-            )
-            logger.info(Fore.YELLOW + f"🚫 Невалидная ссылка Steam: {link}")
+            _reply_invalid_link(account, chat_id, link)
             return
 
-        state["steam_link"] = link
-        state["step"] = "confirm_order"
+        with _STATE_LOCK:
+            if state.step != "waiting_link":
+                return
+            state.steam_link = link
+            state.step = "confirm_order"
 
         msg = (
             "✅ Профиль принят!\n\n"
             f"Профиль: *{link}*\n"
-            f"Очки: *{_points_to_human(state['points'])}*\n"
+            f"Очки: *{_points_to_human(state.points)}*\n"
             "Если всё верно — напишите `+` для оформления пополнения.\n"
             "Если нужен другой профиль — отправьте новую ссылку.\n"
             "Изменить количество очков можно только при оформлении нового заказа."
         )
         account.send_message(chat_id, msg)
-        logger.info(Fore.GREEN + f"✅ Ссылка подтверждена (chat {chat_id}): {link}")
+        logger.info("%s✅ Ссылка подтверждена (chat %s): %s", Fore.GREEN, chat_id, link)
         return
 
-    if state["step"] == "confirm_order":
+    if state.step == "confirm_order":
         if text == "+":
-            EXECUTOR.submit(_process_bsp_order, account, state.copy())
+            with _STATE_LOCK:
+                if state.step != "confirm_order":
+                    return
+                state.step = "processing"
+                snapshot = dataclasses.replace(state)
+            EXECUTOR.submit(_process_bsp_order, account, snapshot)
         else:
             link = text
             if not _steam_link_valid(link):
-                account.send_message(
-                    chat_id,
-                    "⚠️ Невалидная ссылка. Пример:\n"
-                    "`https://steamcommunity.com/id/ваш_id`"
-                )
-                logger.info(Fore.YELLOW + f"🚫 Невалидная ссылка Steam: {link}")
+                _reply_invalid_link(account, chat_id, link)
                 return
-            state["steam_link"] = link
+            with _STATE_LOCK:
+                if state.step != "confirm_order":
+                    return
+                state.steam_link = link
             account.send_message(
                 chat_id,
                 "♻️ Ссылка обновлена!\n"
                 f"Профиль: *{link}*\n"
-                f"Очки: *{_points_to_human(state['points'])}*\n"
+                f"Очки: *{_points_to_human(state.points)}*\n"
                 "Если всё верно — напишите `+` для оформления пополнения."
             )
-            logger.info(Fore.GREEN + f"♻️ Ссылка обновлена (chat {chat_id}): {link}")
+            logger.info("%s♻️ Ссылка обновлена (chat %s): %s", Fore.GREEN, chat_id, link)
         return
 
     account.send_message(
@@ -663,7 +896,63 @@ def handle_new_message(account: Account, message):
         "По вопросам — напишите здесь, поможем."
     )
 
+def _on_new_order(account: Account, order_id):
+    order = account.get_order(order_id)
+    handle_new_order(account, order)
+
+def _on_event_done(fut):
+    _EVENT_SLOTS.release()
+    exc = fut.exception()
+    if exc is not None:
+        logger.error(Fore.RED + "Ошибка при обработке события", exc_info=exc)
+
+def _submit_event(fn, *args):
+    _EVENT_SLOTS.acquire()
+    try:
+        fut = EVENT_POOL.submit(fn, *args)
+    except Exception:
+        _EVENT_SLOTS.release()
+        raise
+    fut.add_done_callback(_on_event_done)
+
+def _run_chat_events(chat_id):
+    while True:
+        with _CHAT_EVENTS_LOCK:
+            pending = _CHAT_EVENTS[chat_id]
+            if not pending:
+                del _CHAT_EVENTS[chat_id]
+                return
+            fn, args = pending.popleft()
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception(Fore.RED + "Ошибка при обработке события")
+        finally:
+            _EVENT_SLOTS.release()
+
+def _submit_chat_event(chat_id, fn, *args):
+    if chat_id is None:
+        _submit_event(fn, *args)
+        return
+    _EVENT_SLOTS.acquire()
+    with _CHAT_EVENTS_LOCK:
+        pending = _CHAT_EVENTS.get(chat_id)
+        if pending is not None:
+            pending.append((fn, args))
+            return
+        _CHAT_EVENTS[chat_id] = collections.deque([(fn, args)])
+    try:
+        EVENT_POOL.submit(_run_chat_events, chat_id)
+    except Exception:
+        with _CHAT_EVENTS_LOCK:
+            _CHAT_EVENTS.pop(chat_id, None)
+        _EVENT_SLOTS.release()
+        raise
+
 def main():
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
     if not FUNPAY_AUTH_TOKEN:
         raise RuntimeError("FUNPAY_AUTH_TOKEN не найден в .env")
     if not BSP_API_KEY:
@@ -680,22 +969,29 @@ def main():
     account.get()
     logger.info(Fore.GREEN + f"🔐 Авторизован как {getattr(account, 'username', '(unknown)')}")
     logger.info(Fore.CYAN + f"Настройки: AUTO_REFUND={AUTO_REFUND}, AUTO_DEACTIVATE={AUTO_DEACTIVATE}, BSP_MIN_BALANCE={BSP_MIN_BALANCE}, DEACTIVATE_CATEGORY_ID={DEACTIVATE_CATEGORY_ID}")
-    logger.info(Fore.CYAN + f"FIXED_LOT_BY_ID={FIXED_LOT_BY_ID}, ALLOW_TITLE_DETECTION={ALLOW_TITLE_DETECTION}")
+    logger.info(Fore.CYAN + f"FIXED_LOT_BY_ID={dict(FIXED_LOT_BY_ID)}, ALLOW_TITLE_DETECTION={ALLOW_TITLE_DETECTION}")
     logger.info(Fore.CYAN + f"NON_MULTIPLE_POINTS_POLICY={NON_MULTIPLE_POINTS_POLICY}")
     logger.info(Fore.CYAN + f"MAX_WORKERS={MAX_WORKERS} (параллельные оформления BSP)")
+    logger.info(Fore.CYAN + f"BSP таймауты: connect={BSP_CONNECT_TIMEOUT} с, заказ={REQUEST_TIMEOUT} с, баланс={BSP_READ_TIMEOUT} с")
+    logger.info(Fore.CYAN + f"EVENT_WORKERS={EVENT_WORKERS}, EVENT_QUEUE_LIMIT={EVENT_QUEUE_LIMIT} (параллельная обработка событий FunPay)")
 
     _log_banner()
 
+    threading.Thread(target=_state_janitor, name="state-janitor", daemon=True).start()
+
     runner = Runner(account)
     logger.info(Style.BRIGHT + Fore.WHITE + "🚀 SteamPointsBot запущен. Ожидаю события...")
 
     for event in runner.listen(requests_delay=3.0):
         try:
             if isinstance(event, NewOrderEvent):
-                order = account.get_order(event.order.id)
-                handle_new_order(account, order)
+                ev_subcat_id = _order_subcategory_id(event.order)
+                if ev_subcat_id is not None and ev_subcat_id != CATEGORY_ID:
+                    logger.debug("%s[ORDER] Пропуск заказа %s (subcategory %s != %s)", Fore.BLUE, event.order.id, ev_subcat_id, CATEGORY_ID)
+                    continue
+                _submit_event(_on_new_order, account, event.order.id)
             elif isinstance(event, NewMessageEvent):
-                handle_new_message(account, event.message)
+                _submit_chat_event(getattr(event.message, "chat_id", None), handle_new_message, account, event.message)
         except Exception:
             logger.exception(Fore.RED + "Ошибка в основном цикле")
 